@@ -77,7 +77,7 @@ class DQNPolicy:
     
     @torch.no_grad()
     def act(self, obs, deterministic=True):
-        obs = torch.Tensor(np.array(obs)).to(self.device)
+        obs = torch.from_numpy(np.asarray(obs, dtype=np.float32)).to(self.device, non_blocking=True)
         return self.q_net(obs).cpu().numpy()
 
     def load(self, model_dir, version=''):
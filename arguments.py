@@ -13,6 +13,8 @@ def get_config():
             specifiy the algorithm, including `["rmappo", "mappo", "rmappg", "mappg", "trpo"]`
         --experiment_name <str>
             an identifier to distinguish different experiment.
+        --verbose
+            by default False. If set, build an env once to print its info before training.
         --seed <int>
             set seed for numpy and torch
         --cuda
@@ -84,6 +86,8 @@ def get_config():
                         help='level of logging')
     parser.add_argument("-E", "--experiment_name", type=str, default="check", 
                         help="an identifier to distinguish different experiment.")
+    parser.add_argument("-v", "--verbose", action='store_true',
+                        help="print the env info before training")
     parser.add_argument("--seed", type=int, default=1, help="Random seed for numpy/torch")
     parser.add_argument("--cuda", action='store_false', default=True, help="by default True, will use GPU to train; or else will use CPU;")
     parser.add_argument("--cuda_deterministic",
@@ -3,6 +3,8 @@ Modified from OpenAI Baselines code to work with multi-agent envs
 """
 import numpy as np
 from multiprocessing import Process, Pipe
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 from gym import Wrapper
 from abc import ABC, abstractmethod
 
@@ -286,9 +288,24 @@ class SubprocVecEnv(ShareVecEnv):
             return np.stack(frame) 
 
 
+class SharedArray(np.ndarray):
+    """
+    Array mapped on a SharedMemory segment. It holds the segment's handle, so the segment
+    is only unmapped (when the handle is collected) after this array and all views of it
+    have been dropped.
+    """
+
+    @classmethod
+    def from_shm(cls, shm, shape, dtype):
+        arr = np.ndarray(shape, dtype, buffer=shm.buf).view(cls)
+        arr.shm = shm
+        return arr
+
+
 def shareworker(remote, parent_remote, env_fn_wrapper):
     parent_remote.close()
     env = env_fn_wrapper()
+    shm_views, slot = None, 0
     while True:
         cmd, data = remote.recv()
         if cmd == 'step':
@@ -300,10 +317,24 @@ def shareworker(remote, parent_remote, env_fn_wrapper):
                 if np.all(done):
                     ob, s_ob, available_actions = env.reset()
 
+            if shm_views is not None:
+                shm_views[0][slot], shm_views[1][slot] = ob, s_ob
+                slot = (slot + 1) % len(shm_views[0])
+                ob = s_ob = None
             remote.send((ob, s_ob, reward, done, info, available_actions))
         elif cmd == 'reset':
             ob, s_ob, available_actions = env.reset()
+            if shm_views is not None:
+                shm_views[0][slot], shm_views[1][slot] = ob, s_ob
+                slot = (slot + 1) % len(shm_views[0])
+                ob = s_ob = None
             remote.send((ob, s_ob, available_actions))
+        elif cmd == 'attach_shm':
+            specs, index = data
+            shm_views = [SharedArray.from_shm(SharedMemory(name), shape, dtype)[:, index]
+                         for name, shape, dtype in specs]
+            slot = 0
+            remote.send(None)
         elif cmd == 'reset_task':
             ob = env.reset_task()
             remote.send(ob)
@@ -315,6 +346,7 @@ def shareworker(remote, parent_remote, env_fn_wrapper):
                 env.render(mode=data)
         elif cmd == 'close':
             env.close()
+            shm_views = None
             remote.close()
             break
         elif cmd == 'get_spaces':
@@ -328,7 +360,12 @@ def shareworker(remote, parent_remote, env_fn_wrapper):
 
 
 class ShareSubprocVecEnv(ShareVecEnv):
-    def __init__(self, env_fns, spaces=None):
+    """
+    After the first reset, the workers write their observations straight into a ring of
+    shared memory slots instead of sending them through the pipes. The returned obs and
+    cent_obs are views into the ring, valid until shm_slots - 1 more steps or resets.
+    """
+    def __init__(self, env_fns, spaces=None, shm_slots=2):
         """
         envs: list of gym environments to run in subprocesses
         """
@@ -340,6 +377,8 @@ class ShareSubprocVecEnv(ShareVecEnv):
                            args=(work_remote, remote, CloudpickleWrapper(env_fn)))
                    for (work_remote, remote, env_fn) in
                    zip(self.work_remotes, self.remotes, env_fns)]
+        # the workers must share our resource tracker, or they would unlink the shared memory on exit
+        resource_tracker.ensure_running()
         for p in self.ps:
             p.daemon = True  # if the main process crashes, we should not cause things to hang
             p.start()
@@ -350,6 +389,27 @@ class ShareSubprocVecEnv(ShareVecEnv):
         ShareVecEnv.__init__(self, len(env_fns), obs_space,
                              cent_obs_space, act_space)
 
+        self.shm_slots = shm_slots
+        self._shm_views = None  # allocated at the first reset, when the obs shapes are known
+        self._slot = 0
+
+    def _attach_shm(self, obs, cent_obs):
+        specs, self._shm_views = [], []
+        for x in (obs, cent_obs):
+            shape = (self.shm_slots, *x.shape)
+            shm = SharedMemory(create=True, size=max(x.nbytes * self.shm_slots, 1))
+            self._shm_views.append(SharedArray.from_shm(shm, shape, x.dtype))
+            specs.append((shm.name, shape, x.dtype))
+        for i, remote in enumerate(self.remotes):
+            remote.send(('attach_shm', (specs, i)))
+        for remote in self.remotes:
+            remote.recv()
+
+    def _read_shm(self):
+        obs, cent_obs = (v[self._slot].view(np.ndarray) for v in self._shm_views)
+        self._slot = (self._slot + 1) % self.shm_slots
+        return obs, cent_obs
+
     def step_async(self, actions):
         for remote, action in zip(self.remotes, actions):
             remote.send(('step', action))
@@ -359,14 +419,23 @@ class ShareSubprocVecEnv(ShareVecEnv):
         results = [remote.recv() for remote in self.remotes]
         self.waiting = False
         obs, cent_obs, rews, dones, infos, available_actions = zip(*results)
-        return np.stack(obs), np.stack(cent_obs), np.stack(rews), np.stack(dones), infos, np.stack(available_actions)
+        if self._shm_views is None:
+            obs, cent_obs = np.stack(obs), np.stack(cent_obs)
+        else:
+            obs, cent_obs = self._read_shm()
+        return obs, cent_obs, np.stack(rews), np.stack(dones), infos, np.stack(available_actions)
 
     def reset(self):
         for remote in self.remotes:
             remote.send(('reset', None))
         results = [remote.recv() for remote in self.remotes]
         obs, cent_obs, available_actions = zip(*results)
-        return np.stack(obs), np.stack(cent_obs), np.stack(available_actions)
+        if self._shm_views is None:
+            obs, cent_obs = np.stack(obs), np.stack(cent_obs)
+            self._attach_shm(obs, cent_obs)
+        else:
+            obs, cent_obs = self._read_shm()
+        return obs, cent_obs, np.stack(available_actions)
 
     def reset_task(self):
         for remote in self.remotes:
@@ -383,6 +452,10 @@ class ShareSubprocVecEnv(ShareVecEnv):
             remote.send(('close', None))
         for p in self.ps:
             p.join()
+        # the segments stay mapped until the caller drops the last obs views into them
+        for v in self._shm_views or ():
+            v.shm.unlink()
+        self._shm_views = None
         self.closed = True
 
 
@@ -709,13 +782,10 @@ class ShareDummyVecEnv(ShareVecEnv):
         obs, cent_obs, rews, dones, infos, available_actions = map(
             np.array, zip(*results))
 
-        for (i, done) in enumerate(dones):
-            if 'bool' in done.__class__.__name__:
-                if done:
-                    obs[i], cent_obs[i], available_actions[i] = self.envs[i].reset()
-            else:
-                if np.all(done):
-                    obs[i], cent_obs[i], available_actions[i] = self.envs[i].reset()
+        # only the envs whose episode is over need a reset
+        done_envs = dones.reshape(len(self.envs), -1).all(axis=1)
+        for i in np.flatnonzero(done_envs):
+            obs[i], cent_obs[i], available_actions[i] = self.envs[i].reset()
         self.actions = None
 
         return obs, cent_obs, rews, dones, infos, available_actions
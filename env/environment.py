@@ -71,9 +71,8 @@ class MultiCellNetEnv(MultiAgentEnv):
             dpi_sample_rate=dpi_sample_rate
         )
         
-        if episode_len is None:
-            episode_len = round(self.episode_time_len / accelerate / time_step / action_interval)
-        self.episode_len = episode_len
+        self.episode_len = self.compute_episode_len(
+            episode_len, accelerate, time_step, action_interval)
         self.action_interval = action_interval
         
         self.observation_space = [self.net.bs_obs_space
@@ -100,6 +99,21 @@ class MultiCellNetEnv(MultiAgentEnv):
         
         self.seed()
 
+    @classmethod
+    def compute_episode_len(cls, episode_len=None, accelerate=config.accelRate,
+                            time_step=config.timeStep, action_interval=action_interval,
+                            **kwargs):
+        """ Number of steps per episode, without building the environment. """
+        if episode_len is None:
+            episode_len = round(cls.episode_time_len / accelerate / time_step / action_interval)
+        return episode_len
+
+    @classmethod
+    def make_traffic_model(cls, scenario=config.trafficScenario, area_size=net_config.areaSize,
+                           dpi_sample_rate=None, **kwargs):
+        """ Traffic model of the environment, without building the network. """
+        return TrafficModel.from_scenario(scenario, area=area_size, sample_rate=dpi_sample_rate)
+
     def print_info(self):
         notice('Start time: {}'.format(self.net.world_time_repr))
         notice('Acceleration: {}'.format(self.net.accelerate))
@@ -7,6 +7,7 @@ import socket
 import numpy as np
 from arguments import *
 from env import MultiCellNetEnv
+from env import config as env_config
 from utils import *
 from env.env_wrappers import ShareSubprocVecEnv, ShareDummyVecEnv
 
@@ -18,20 +19,21 @@ def get_env_kwargs(args):
     return {k: v for k, v in vars(args).items() if v is not None}
 
 def get_default_env_config(args, env_args):
-    tmp_env = MultiCellNetEnv(**get_env_kwargs(env_args))
-    tmp_env.print_info()
-    # tmp_env.net.traffic_model.print_info()
+    kwargs = get_env_kwargs(env_args)
+    if args.verbose:
+        MultiCellNetEnv(**kwargs).print_info()
+    traffic_model = MultiCellNetEnv.make_traffic_model(**kwargs)
     args.__dict__.update(
-        episode_length=tmp_env.episode_len // args.n_rollout_threads,
-        episode_secs=tmp_env.episode_time_len,
-        avg_traffic_density=tmp_env.net.traffic_model.density_mean,
-        traffic_density_std=tmp_env.net.traffic_model.density_std,
-        accelerate=tmp_env.net.accelerate,
-        # w_pc=tmp_env.w_pc,
-        w_qos=tmp_env.w_qos,
-        w_xqos=tmp_env.w_xqos,
-        # w_drop=tmp_env.w_drop,
-        # w_delay=tmp_env.w_delay,
+        episode_length=MultiCellNetEnv.compute_episode_len(**kwargs) // args.n_rollout_threads,
+        episode_secs=MultiCellNetEnv.episode_time_len,
+        avg_traffic_density=traffic_model.density_mean,
+        traffic_density_std=traffic_model.density_std,
+        accelerate=kwargs.get('accelerate', env_config.accelRate),
+        # w_pc=kwargs.get('w_pc', MultiCellNetEnv.w_pc),
+        w_qos=kwargs.get('w_qos', MultiCellNetEnv.w_qos),
+        w_xqos=kwargs.get('w_xqos', MultiCellNetEnv.w_xqos),
+        # w_drop=kwargs.get('w_drop', MultiCellNetEnv.w_drop),
+        # w_delay=kwargs.get('w_delay', MultiCellNetEnv.w_delay),
     )
 
 def make_env(args, env_args, for_eval=False):
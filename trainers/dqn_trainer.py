@@ -1,6 +1,7 @@
 import argparse
 import os
-import random
+import queue
+import threading
 import time
 from argparse import ArgumentParser
 
@@ -12,10 +13,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from tqdm import trange
-from stable_baselines3.common.buffers import ReplayBuffer
 
 from agents.dqn import QNetwork
 from .trainer import BaseTrainer
+from .utils import ReplayBuffer, BatchPrefetcher
 from utils import notice
 
 
@@ -26,6 +27,8 @@ def get_dqn_config():
         help="the learning rate of the optimizer")
     parser.add_argument("--buffer-size", type=int, default=20000,
         help="the replay memory buffer size")
+    parser.add_argument("--buffer-obs-dtype", type=str, default=None, choices=["float32", "float16"],
+        help="the dtype observations are stored in the replay memory (float16 halves its size)")
     parser.add_argument("--gamma", type=float, default=0.99,
         help="the discount factor gamma")
     parser.add_argument("--tau", type=float, default=1.,
@@ -44,13 +47,63 @@ def get_dqn_config():
         help="timestep to start learning")
     parser.add_argument("--train-frequency", type=int, default=10,
         help="the frequency of training")
+    parser.add_argument("--prefetch-batches", type=int, default=2,
+        help="the number of minibatches copied to the GPU ahead of time (0 to disable)")
+    parser.add_argument("--compile", action="store_true",
+        help="compile the loss computation with torch.compile")
+    parser.add_argument("--cuda-graph", action="store_true",
+        help="capture the whole update step into a CUDA graph and replay it (CUDA only)")
+    parser.add_argument("--async-learner", action="store_true",
+        help="run the gradient updates in a background thread, overlapping them with env stepping")
     
     return parser
 
 
-def linear_schedule(start_e: float, end_e: float, duration: int, t: int):
+def linear_schedule(start_e: float, end_e: float, duration: int, t):
     slope = (end_e - start_e) / duration
-    return max(slope * t + start_e, end_e)
+    return np.maximum(slope * t + start_e, end_e)
+
+
+class LearnerThread(threading.Thread):
+    """
+    Background thread running the gradient updates requested by the sampling loop.
+    :param update_fn: (callable) function performing one update given the env steps.
+    :param max_pending: (int) max number of pending updates before the sampler blocks.
+    """
+    def __init__(self, update_fn, max_pending=4):
+        super().__init__(daemon=True)
+        self.update_fn = update_fn
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+
+    def run(self):
+        try:
+            while True:
+                steps = self.pending.get()
+                if steps is None:
+                    break
+                self.update_fn(steps)
+        except BaseException as e:
+            self.error = e
+
+    def put(self, steps):
+        """Request an update, blocking while the learner is too far behind."""
+        while True:
+            self._check()
+            try:
+                self.pending.put(steps, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def join(self):
+        self.put(None)
+        super().join()
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("learner thread failed") from self.error
 
 
 class DQNTrainer(BaseTrainer):
@@ -62,85 +115,174 @@ class DQNTrainer(BaseTrainer):
 
         args = config['all_args']
         self.lr = args.learning_rate
+        self.gamma = args.gamma
         self.q_net = QNetwork(self.observation_space, self.action_space).to(self.device)
         self.targ_net = QNetwork(self.observation_space, self.action_space).to(self.device)
         self.targ_net.load_state_dict(self.q_net.state_dict())
+        self._net_params = list(self.q_net.parameters())
+        self._targ_params = list(self.targ_net.parameters())
+        # fused Adam updates all parameters in a single kernel on GPU
+        self.use_cuda_graph = args.cuda_graph and self.device.type == 'cuda'
+        self.optimizer = optim.Adam(self.q_net.parameters(), lr=self.lr, weight_decay=1e-5,
+                                    fused=self.device.type == 'cuda',
+                                    capturable=self.use_cuda_graph)
+        self._graph = None  # captured at the first update
+        if self.q_net.multi_discrete:
+            self.action_dims = np.asarray(self.q_net.action_dims)
+        else:  # Discrete
+            self.action_dims = self.action_space.n
+
+        # staging tensors reused by take_actions to avoid per-step allocations
+        obs_shape = (self.n_rollout_threads, self.num_agents, *self.observation_space.shape)
+        self._obs_cpu = torch.empty(obs_shape, pin_memory=self.device.type == 'cuda')
+        if self.device.type == 'cpu':
+            self._obs_dev = self._obs_cpu
+        else:
+            self._obs_dev = torch.empty_like(self._obs_cpu, device=self.device)
 
         self.rb = ReplayBuffer(
             args.buffer_size,
+            self.n_rollout_threads * self.num_agents,
             self.observation_space,
             self.action_space,
             self.device,
-            handle_timeout_termination=False,
+            obs_dtype=args.buffer_obs_dtype,
         )
+        self._rb_lock = threading.Lock()
+        self._net_lock = threading.Lock()
+
+        # per-agent rewards and dones of a step, filled in place by broadcasting
+        self._rew_scratch = np.empty((self.n_rollout_threads, self.num_agents), dtype=np.float32)
+        self._done_scratch = np.empty((self.n_rollout_threads, self.num_agents), dtype=bool)
+
+        self._compute_loss = self.compute_loss
+        if args.compile and not self.use_cuda_graph:
+            # batches have a fixed shape, so the graph is only compiled once
+            self._compute_loss = torch.compile(
+                self.compute_loss, mode="reduce-overhead", dynamic=False)
     
     def train(self):
-        optimizer = optim.Adam(self.q_net.parameters(), lr=self.lr, weight_decay=1e-5)
-        start_time = time.time()
-
         envs = self.envs
         args = self.all_args
         writer = self.writer
+
+        if self.device.type == 'cuda' and args.prefetch_batches > 0:
+            prefetcher = BatchPrefetcher(self.rb, args.batch_size, args.prefetch_batches)
+            sample_batch = prefetcher.sample
+        else:
+            sample_batch = lambda: self.rb.sample(args.batch_size)
+        
+        log_buffer = []
+        last_step, last_ns = 0, time.perf_counter_ns()
+
+        def flush_logs():
+            nonlocal last_step, last_ns
+            if not log_buffer:
+                return
+            log_steps, log_times, log_values = zip(*log_buffer)
+            log_values = torch.stack(log_values).cpu().numpy()  # a single device sync
+            for steps, t, (td_loss, q_values) in zip(log_steps, log_times, log_values):
+                # rate over the window since the previous record, not since the start
+                sps = int((steps - last_step) * 1e9 / max(t - last_ns, 1))
+                last_step, last_ns = steps, t
+                writer.add_scalar("losses/td_loss", td_loss, steps)
+                writer.add_scalar("losses/q_values", q_values, steps)
+                writer.add_scalar("charts/SPS", sps, steps)
+            pbar.set_postfix(SPS=sps, td_loss=td_loss)
+            log_buffer.clear()
+
+        def update(steps):
+            with self._rb_lock:
+                data = sample_batch()
+            with self._net_lock:
+                if self.use_cuda_graph:
+                    if self._graph is None:
+                        self._capture_graph(data)
+                    for static_x, x in zip(self._static_batch, data):
+                        static_x.copy_(x)
+                    self._graph.replay()
+                    loss, old_val = self._static_loss, self._static_q
+                else:
+                    loss, old_val = self._compute_loss(
+                        data.observations, data.next_observations,
+                        data.actions, data.rewards, data.dones)
+
+                    # optimize the model
+                    self.optimizer.zero_grad()
+                    loss.backward()
+                    self.optimizer.step()
+
+                if steps % 1000 == 0:
+                    # keep the stats on the device until they are written out
+                    stats = torch.stack([loss.detach(), old_val.detach().mean()])
+
+            # log without holding the lock, which take_actions waits for
+            if steps % 1000 == 0:
+                log_buffer.append((steps, time.perf_counter_ns(), stats))
+                if len(log_buffer) >= 10:
+                    flush_logs()
+
+        if args.async_learner:
+            learner = LearnerThread(update)
+            learner.start()
         
         episodes = 0
         obs, _, _ = envs.reset()
         
-        pbar = trange(args.num_env_steps // args.n_rollout_threads)
+        total_steps = args.num_env_steps // args.n_rollout_threads
+        eps_schedule = linear_schedule(
+            args.start_e, args.end_e, args.exploration_fraction * args.num_env_steps,
+            np.arange(1, total_steps + 1) * args.n_rollout_threads).astype(np.float32)
+
+        # loop invariants, bound to locals outside the hot loop
+        n_threads, num_envs, num_agents = args.n_rollout_threads, envs.num_envs, self.num_agents
+        learning_starts, train_freq = args.learning_starts, args.train_frequency
+        target_freq, tau = args.target_network_frequency, args.tau
+        async_learner, action_dims = args.async_learner, self.action_dims
+        rb, rb_lock, net_lock = self.rb, self._rb_lock, self._net_lock
+        rew_scratch, done_scratch = self._rew_scratch, self._done_scratch
+
+        pbar = trange(total_steps)
         for step in pbar:
-            steps = (step + 1) * args.n_rollout_threads
-            epsilon = linear_schedule(args.start_e, args.end_e, args.exploration_fraction * args.num_env_steps, steps)
+            steps = (step + 1) * n_threads
+            epsilon = eps_schedule[step]
             
-            if random.random() < epsilon:
-                actions = np.array([[s.sample() for s in envs.action_space] for _ in range(envs.num_envs)])
-            else:
-                actions = self.take_actions(obs)
+            # epsilon-greedy with one coin per env, shared by all of its agents
+            actions = self.take_actions(obs)
+            if epsilon > 0:  # fully greedy once exploration has decayed to 0
+                explore = np.random.random(actions.shape[0]) < epsilon
+                rand_actions = np.random.randint(action_dims, size=actions.shape)
+                explore = explore.reshape(-1, *(1,) * (actions.ndim - 1))  # over agents (and action dims)
+                actions = np.where(explore, rand_actions, actions)
                 
             # TRY NOT TO MODIFY: execute the game and log data.
             next_obs, _ , rewards, done, infos, _ = envs.step(actions)
 
-            obs = obs.reshape(-1, obs.shape[-1])
-            obs1 = next_obs.reshape(-1, next_obs.shape[-1])
-            actions = actions.reshape(-1, actions.shape[-1])
-            rewards = np.repeat(rewards.reshape(-1, 1), self.num_agents, axis=1).reshape(-1)
-            dones = np.repeat(done.reshape(-1, 1), self.num_agents, axis=1).reshape(-1)
-            assert len(obs) == len(obs1) == len(actions) == len(rewards) == len(dones) \
-                == envs.num_envs * self.num_agents
+            np.copyto(rew_scratch, rewards.reshape(-1, 1))  # shared reward of all agents
+            np.copyto(done_scratch, done.reshape(-1, 1))
+            assert obs.shape[:2] == next_obs.shape[:2] == actions.shape[:2] == (num_envs, num_agents)
             
             # TRY NOT TO MODIFY: save data to replay buffer; handle `final_observation`
-            for ob, ob1, a, r, d in zip(obs, obs1, actions, rewards, dones):
-                self.rb.add(ob, ob1, a, r, d, {})
+            # obs is the next_obs of the previous step, which the buffer does not copy again
+            with rb_lock:
+                rb.add(obs, next_obs, actions, rew_scratch, done_scratch)
 
             # TRY NOT TO MODIFY: CRUCIAL step easy to overlook
             obs = next_obs
             
             # ALGO LOGIC: training.
             
-            if steps > args.learning_starts:
-                if steps % args.train_frequency == 0:
-                    data = self.rb.sample(args.batch_size)
-                    with torch.no_grad():
-                        target_max, _ = self.targ_net.net(data.next_observations).max(dim=1)
-                        td_target = data.rewards.flatten() + args.gamma * target_max * (1 - data.dones.flatten())
-                    old_val = self.q_net.gather(data.observations, data.actions)
-                    loss = F.mse_loss(td_target, old_val)
-
-                    if steps % 1000 == 0:
-                        writer.add_scalar("losses/td_loss", loss, steps)
-                        writer.add_scalar("losses/q_values", old_val.mean().item(), steps)
-                        writer.add_scalar("charts/SPS", int(steps / (time.time() - start_time)), steps)
-                        pbar.set_postfix(SPS=int(steps / (time.time() - start_time)), td_loss=loss.item())
-
-                    # optimize the model
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
+            if steps > learning_starts:
+                if steps % train_freq == 0:
+                    if async_learner:
+                        learner.put(steps)
+                    else:
+                        update(steps)
 
                 # update target network
-                if steps % args.target_network_frequency == 0:
-                    for self.targ_net_param, self.net_param in zip(self.targ_net.parameters(), self.q_net.parameters()):
-                        self.targ_net_param.data.copy_(
-                            args.tau * self.net_param.data + (1.0 - args.tau) * self.targ_net_param.data
-                        )
+                if steps % target_freq == 0:
+                    with net_lock:
+                        self.update_target(tau)
         
             if done.any():
                 assert done.all()
@@ -154,17 +296,90 @@ class DQNTrainer(BaseTrainer):
                     rew_info.index = ['_'.join(idx) for idx in rew_info.index]
                     self.log_train(rew_info, steps)
 
+        if args.async_learner:
+            learner.join()
+        flush_logs()
+
+    def compute_loss(self, obs, next_obs, actions, rewards, dones):
+        """
+        Compute the TD loss of a batch of transitions.
+        :return loss: (torch.Tensor) mean squared TD error.
+        :return q_values: (torch.Tensor) Q-values of the taken actions.
+        """
+        with torch.no_grad():
+            target_max, _ = self.targ_net.net(next_obs).max(dim=1)
+            td_target = rewards.view(-1) + self.gamma * target_max * (1 - dones.view(-1))
+        old_val = self.q_net.gather(obs, actions)
+        return F.mse_loss(td_target, old_val), old_val
+
+    def _capture_graph(self, data):
+        """
+        Capture the loss, backward pass and optimizer step into a CUDA graph. The batch
+        is copied into static tensors, which are then used for warm-up updates on a side
+        stream, as required before capturing.
+        :param data: (ReplayBufferSamples) batch of transitions with the shapes to capture.
+        """
+        static = self._static_batch = type(data)(*(x.clone() for x in data))
+        args = (static.observations, static.next_observations,
+                static.actions, static.rewards, static.dones)
+
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self.optimizer.zero_grad(set_to_none=True)
+                loss, _ = self.compute_loss(*args)
+                loss.backward()
+                self.optimizer.step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # grads are allocated from the graph's pool, so each replay overwrites them
+        self.optimizer.zero_grad(set_to_none=True)
+        self._graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._graph):
+            self._static_loss, self._static_q = self.compute_loss(*args)
+            self._static_loss.backward()
+            self.optimizer.step()
+
+    @torch.no_grad()
+    def update_target(self, tau):
+        """Move the target network parameters towards the Q-network by rate tau."""
+        if tau == 1.0:  # hard update
+            torch._foreach_copy_(self._targ_params, self._net_params)
+        else:
+            torch._foreach_mul_(self._targ_params, 1.0 - tau)
+            torch._foreach_add_(self._targ_params, self._net_params, alpha=tau)
+
+    @torch.inference_mode()
     def take_actions(self, obs):
-        return np.array([self.q_net(torch.Tensor(ob).to(self.device))
-                         .cpu().numpy() for ob in obs])
+        with self._net_lock:
+            self._obs_cpu.copy_(torch.from_numpy(obs))
+            if self._obs_dev is not self._obs_cpu:
+                self._obs_dev.copy_(self._obs_cpu, non_blocking=True)
+            return self.q_net(self._obs_dev).cpu().numpy()
 
     def save(self, version=''):
         path = os.path.join(self.save_dir, f"dqn{version}.pt")
         notice(f"Saving model to {path}")
-        torch.save(self.q_net.state_dict(), path)
+        with self._net_lock:
+            torch.save(self.q_net.state_dict(), path)
+            torch.save(self.optimizer.state_dict(), self._optim_path(self.save_dir, version))
 
     def load(self, version=''):
         path = os.path.join(self.model_dir, f"dqn{version}.pt")
         notice(f"Loading model from {path}")
         self.q_net.load_state_dict(torch.load(path))
         self.targ_net.load_state_dict(self.q_net.state_dict())
+        optim_path = self._optim_path(self.model_dir, version)
+        if os.path.exists(optim_path):  # not saved with older models
+            state = torch.load(optim_path, map_location=self.device)
+            # keep the moments but take the hyperparameters and kernel flags of this run,
+            # which may differ from the saved ones (e.g. CPU vs CUDA, --cuda-graph)
+            for group in state['param_groups']:
+                group.update(lr=self.lr, fused=self.device.type == 'cuda',
+                             capturable=self.use_cuda_graph)
+            self.optimizer.load_state_dict(state)
+
+    @staticmethod
+    def _optim_path(model_dir, version=''):
+        return os.path.join(model_dir, f"dqn_optim{version}.pt")
@@ -5,6 +5,7 @@ import numpy as np
 from .valuenorm import ValueNorm
 from .shared_buffer import SharedReplayBuffer
 from .separated_buffer import SeparatedReplayBuffer
+from .replay_buffer import ReplayBuffer, ReplayBufferSamples, BatchPrefetcher
 
 
 def check(input):
@@ -0,0 +1,213 @@
+import torch
+import numpy as np
+from collections import namedtuple, deque
+from .space_utils import *
+
+
+ReplayBufferSamples = namedtuple(
+    'ReplayBufferSamples',
+    ['observations', 'actions', 'next_observations', 'dones', 'rewards'])
+
+
+class ReplayBuffer(object):
+    """
+    Circular buffer of off-policy transitions collected from parallel streams.
+    Observations are kept in a single array with one extra slot, so that the next
+    observation of the transition at step t is read from the slot t + 1.
+    :param buffer_size: (int) max number of transitions stored in the buffer.
+    :param num_streams: (int) number of transitions added per step (n_envs * n_agents).
+    :param obs_space: (gym.Space) observation space of agents.
+    :param act_space: (gym.Space) action space of agents.
+    :param device: (torch.device) device the sampled tensors are moved to.
+    :param obs_dtype: (np.dtype) dtype the observations are stored in; they are cast back
+        to float32 when sampled. By default, integer observations keep their own dtype and
+        all other observations are stored in float32.
+    """
+
+    def __init__(self, buffer_size, num_streams, obs_space, act_space, device=torch.device("cpu"),
+                 obs_dtype=None):
+        self.num_streams = num_streams
+        self.capacity = max(buffer_size // num_streams, 2)
+        self.device = device
+
+        obs_shape = get_shape_from_obs_space(obs_space)
+        act_shape = get_shape_from_act_space(act_space)
+        if isinstance(act_shape, int):
+            act_shape = (act_shape,)
+
+        if obs_dtype is None:
+            obs_dtype = getattr(obs_space, 'dtype', None)
+            if obs_dtype is None or not np.issubdtype(obs_dtype, np.integer):
+                obs_dtype = np.float32
+
+        self.obs = np.zeros((self.capacity + 1, num_streams, *obs_shape), dtype=obs_dtype)
+        self.actions = np.zeros((self.capacity, num_streams, *act_shape), dtype=np.int64)
+        self.rewards = np.zeros((self.capacity, num_streams, 1), dtype=np.float32)
+        self.dones = np.zeros((self.capacity, num_streams, 1), dtype=np.float32)
+
+        # next_obs of the transitions followed by an obs other than it (e.g. a final obs followed
+        # by the reset obs), whose slot t + 1 in self.obs has been taken by that obs
+        self._next_obs_patches = {}
+        self._patched = np.zeros(self.capacity, dtype=bool)
+
+        self.step = 0
+        self.full = False
+        self._last_next_obs = None
+
+    def __len__(self):
+        return (self.capacity if self.full else self.step) * self.num_streams
+
+    def add(self, obs, next_obs, actions, rewards, dones):
+        """
+        Insert a step of transitions into the buffer. The inputs are not modified.
+        The obs of a step shares its slot with the next_obs of the previous step. If obs
+        is the next_obs array of the previous call, it is not copied again, so it must not
+        be changed in place between the calls. Otherwise, if its values differ, the previous
+        next_obs is moved aside first so that the previous transitions stay intact.
+        :param obs: (np.ndarray) observations of each stream.
+        :param next_obs: (np.ndarray) observations of each stream after the step.
+        :param actions: (np.ndarray) actions taken in each stream.
+        :param rewards: (np.ndarray) rewards received in each stream.
+        :param dones: (np.ndarray) whether the episode of each stream has ended.
+        """
+        S, obs_shape = self.num_streams, self.obs.shape[2:]
+        if self._patched[self.step]:  # the transition being overwritten
+            self._patched[self.step] = False
+            del self._next_obs_patches[self.step]
+        if self.step == 0:
+            # slot 0 holds no next_obs, the last transition's next_obs is in slot capacity
+            self.obs[0] = obs.reshape(S, *obs_shape)
+        elif obs is not self._last_next_obs:
+            obs = obs.reshape(S, *obs_shape)
+            if not np.array_equal(obs, self.obs[self.step]):
+                self._next_obs_patches[self.step - 1] = self.obs[self.step].copy()
+                self._patched[self.step - 1] = True
+                self.obs[self.step] = obs
+        self.obs[self.step + 1] = next_obs.reshape(S, *obs_shape)
+        self._last_next_obs = next_obs
+        self.actions[self.step] = actions.reshape(S, -1)
+        self.rewards[self.step] = rewards.reshape(S, 1)
+        self.dones[self.step] = dones.reshape(S, 1)
+
+        self.step += 1
+        if self.step == self.capacity:
+            self.step, self.full = 0, True
+
+    def _sample_indices(self, batch_size):
+        if self.full:
+            # the obs slot of the oldest step has been overwritten by the latest next_obs
+            t = (self.step + 1 + np.random.randint(0, self.capacity - 1, size=batch_size)) % self.capacity
+        else:
+            t = np.random.randint(0, self.step, size=batch_size)
+        j = np.random.randint(0, self.num_streams, size=batch_size)
+        return t * self.num_streams + j  # index into the arrays flattened over (step, stream)
+
+    def empty_batch(self, batch_size, pin_memory=False):
+        """
+        Allocate host tensors that a batch of transitions can be gathered into.
+        :param batch_size: (int) number of transitions in the batch.
+        :param pin_memory: (bool) whether to allocate the tensors in page-locked memory.
+        :return samples: (ReplayBufferSamples) uninitialized tensors with the buffer's dtypes.
+        """
+        def empty(x):
+            return torch.empty((batch_size, *x.shape[2:]), dtype=torch.from_numpy(x[:0]).dtype,
+                               pin_memory=pin_memory)
+        return ReplayBufferSamples(
+            observations=empty(self.obs),
+            actions=empty(self.actions),
+            next_observations=empty(self.obs),
+            dones=empty(self.dones),
+            rewards=empty(self.rewards),
+        )
+
+    def gather(self, out):
+        """
+        Sample transitions uniformly from the buffer into preallocated host tensors.
+        :param out: (ReplayBufferSamples) host tensors from empty_batch, filled in place.
+        :return out: (ReplayBufferSamples) the filled tensors, still in the buffer's dtypes.
+        """
+        i = self._sample_indices(len(out.actions))
+        S = self.num_streams
+        # mode='clip' below avoids the extra buffering np.take does by default when given out,
+        # but it would also silently clamp a bad index, so check the largest one (of next_obs)
+        assert i.max() + S < len(self.obs) * S, "replay buffer index out of range"
+        for x, idx, y in zip(
+                (self.obs, self.actions, self.obs, self.dones, self.rewards),
+                (i, i, i + S, i, i), out):
+            np.take(x.reshape(-1, *x.shape[2:]), idx, axis=0, out=y.numpy(), mode='clip')
+        t = i // S
+        for k in np.flatnonzero(self._patched[t]):
+            out.next_observations[k] = torch.from_numpy(self._next_obs_patches[t[k]][i[k] % S])
+        return out
+
+    def to_device(self, batch, non_blocking=False):
+        """
+        Move a gathered batch to the buffer's device and cast the observations to float32.
+        :param batch: (ReplayBufferSamples) host tensors from gather.
+        :param non_blocking: (bool) copy asynchronously, only effective from pinned memory.
+        :return samples: (ReplayBufferSamples) batch of transitions on the buffer's device.
+        """
+        batch = ReplayBufferSamples(*(x.to(self.device, non_blocking=non_blocking) for x in batch))
+        return batch._replace(observations=batch.observations.float(),
+                              next_observations=batch.next_observations.float())
+
+    def sample(self, batch_size):
+        """
+        Sample a batch of transitions uniformly from the buffer.
+        :param batch_size: (int) number of transitions to sample.
+        :return samples: (ReplayBufferSamples) batch of transitions as tensors on the buffer's device.
+        """
+        return self.to_device(self.gather(self.empty_batch(batch_size)))
+
+
+class BatchPrefetcher(object):
+    """
+    Samples minibatches from a replay buffer ahead of time and copies them to the
+    GPU on a side CUDA stream, so that the transfer overlaps with the current update.
+    The batches are gathered straight into pinned host buffers, which are reused.
+    :param buffer: (ReplayBuffer) buffer on a CUDA device to sample from.
+    :param batch_size: (int) number of transitions in each batch.
+    :param num_batches: (int) number of batches kept in flight.
+    """
+
+    def __init__(self, buffer, batch_size, num_batches=2):
+        assert buffer.device.type == 'cuda', "prefetching requires a CUDA device"
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.stream = torch.cuda.Stream(device=buffer.device)
+        self.batches = deque()
+        # one more host buffer than the batches in flight, so that by the time a buffer
+        # is refilled its previous copy has normally finished and the wait is free
+        self.host_batches = [buffer.empty_batch(batch_size, pin_memory=True)
+                             for _ in range(num_batches + 1)]
+        self.host_events = [None] * len(self.host_batches)
+        self.next_host = 0
+
+    def _submit(self):
+        k = self.next_host
+        self.next_host = (k + 1) % len(self.host_batches)
+        if self.host_events[k] is not None:
+            self.host_events[k].synchronize()  # the previous copy from this buffer must be done
+        host_batch = self.buffer.gather(self.host_batches[k])
+        with torch.cuda.stream(self.stream):
+            batch = self.buffer.to_device(host_batch, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.host_events[k] = event
+        self.batches.append((batch, event))
+
+    def sample(self):
+        """
+        Return the oldest prefetched batch and submit a new one.
+        :return samples: (ReplayBufferSamples) batch of transitions ready on the current stream.
+        """
+        while len(self.batches) < self.num_batches:
+            self._submit()
+        batch, event = self.batches.popleft()
+        current_stream = torch.cuda.current_stream(self.buffer.device)
+        current_stream.wait_event(event)
+        for x in batch:
+            x.record_stream(current_stream)
+        self._submit()
+        return batch